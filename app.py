@@ -1,14 +1,33 @@
 import os
+import asyncio
+import functools
+import hashlib
+import shutil
 import tempfile
-import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from pathlib import Path
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import HTMLResponse, Response
+
+import aiofiles
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import HTMLResponse, FileResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, ValueTarget
+from streaming_form_data.validators import MaxSizeValidator, ValidationError
 
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi import Request
 
+import pipeline
+from pipeline import GS_PRESETS, _safe_decode, logger
 
 
 APP_NAME = "pdflight"
@@ -19,14 +38,139 @@ MAX_MB = int(os.getenv("PDFLIGHT_MAX_MB", "30"))
 DEFAULT_PRESET = os.getenv("PDFLIGHT_DEFAULT_PRESET", "ebook")  # screen|ebook|printer|prepress
 ENABLE_OCR_DEFAULT = os.getenv("PDFLIGHT_OCR_DEFAULT", "0") == "1"
 
-GS_PRESETS = {
-    "screen": "/screen",
-    "ebook": "/ebook",
-    "printer": "/printer",
-    "prepress": "/prepress",
-}
+CPUS = os.cpu_count() or 1
+WORKERS = max(1, int(os.getenv("PDFLIGHT_WORKERS", "0")) or CPUS)
+
+# Upload chunks from the ASGI server are small (~64 KiB): write them in 1 MiB batches
+UPLOAD_BUFFER_SIZE = 1 << 20
+
+# Readers accept the %PDF- header anywhere in the first KiB of the file
+PDF_HEADER = b"%PDF-"
+PDF_HEADER_WINDOW = 1024
+
+# Multipart boundaries/headers and the small form fields on top of the PDF itself
+FORM_OVERHEAD_BYTES = 64 * 1024
+FORM_FIELDS = ("preset", "ocr", "autorotate", "deskew", "clean", "oversample")
+# The fields are short tokens ("ebook", "1"): cap them, they are buffered in memory
+# and chunked bodies carry no Content-Length to check up front
+FORM_FIELD_MAX_BYTES = 1024
+
+# Working directory on tmpfs (RAM) when available: the job's PDFs and the temporary files
+# of gs/ocrmypdf/tesseract (TMPDIR points there during the job) stay off the disk.
+# tmpfs usage counts as memory: size it (e.g. docker `shm_size`) for WORKERS concurrent jobs.
+TMP_ROOT = os.getenv("PDFLIGHT_TMP", "/dev/shm")
+if not Path(TMP_ROOT).is_dir():
+    TMP_ROOT = tempfile.gettempdir()
+# input + gs output + final output + margin: below this much free space (x upload size)
+# the job goes to disk
+TMP_SPACE_FACTOR = 4
+
+# Converted PDFs keyed by sha256(input) + parameters, LRU-evicted (mtime) above the size cap.
+CACHE_DIR = Path(os.getenv("PDFLIGHT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pdflight_cache")))
+CACHE_MAX_MB = int(os.getenv("PDFLIGHT_CACHE_MB", "512"))  # 0 = cache disabled
+if CACHE_MAX_MB > 0:
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+# Conversions submitted to EXEC and not finished yet (running or queued)
+_BUSY = 0
+
+# Conversions in progress, by cache path: resolved when the result is in the cache (or failed)
+_INFLIGHT: dict[Path, asyncio.Future] = {}
+
+# Conversion pipelines (pipeline.run: gs -> ocrmypdf/pikepdf) run in a pool of worker
+# processes, one document per core; the event loop only streams uploads/downloads.
+# forkserver: never fork() the multi-threaded uvicorn process.
+def _new_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=WORKERS,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=pipeline.warmup,
+    )
+
+
+EXEC = _new_pool()
+_EXEC_LOCK = asyncio.Lock()
+
+
+async def _in_worker(fn, *args, **kwargs):
+    """
+    Esegue fn in un processo di EXEC. Un worker morto (OOM kill, segfault) rende
+    inutilizzabile l'intero pool: lo si ricrea e la richiesta fallisce con 503.
+    """
+    global EXEC
+    pool = EXEC
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            pool, functools.partial(fn, *args, **kwargs)
+        )
+    except BrokenProcessPool:
+        async with _EXEC_LOCK:
+            # every job of the broken pool lands here: only the first one replaces it
+            if EXEC is pool:
+                logger.error("conversion worker died, restarting the worker pool")
+                EXEC = _new_pool()
+                pool.shutdown(wait=False, cancel_futures=True)
+        raise HTTPException(
+            status_code=503,
+            detail="Conversion worker crashed, please retry.",
+            headers={"Retry-After": "1"},
+        ) from None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start (and warm up) every worker now rather than on the first requests:
+    # the pool spawns one process per job submitted while none is idle.
+    await asyncio.gather(*(_in_worker(os.getpid) for _ in range(WORKERS)))
+    yield
+    EXEC.shutdown(cancel_futures=True)
+
+
+def _already_compressed(content_type: str) -> bool:
+    content_type = content_type.split(";", 1)[0].strip().lower()
+    if content_type == "image/svg+xml":
+        return False
+    return content_type == "application/pdf" or content_type.startswith("image/")
+
 
-app = FastAPI(title=APP_NAME)
+class _TextGZipMiddleware:
+    """
+    GZipMiddleware solo per contenuti testuali. PDF e immagini sono già compressi
+    (Flate/JPEG/PNG): gzip vi risparmia ~0-2% (o li ingrandisce) al costo di ~30 ms/MB
+    di CPU sull'event loop, e la risposta perde Content-Length (niente progresso del
+    download). Si decide dal Content-Type della risposta.
+    """
+
+    def __init__(self, app, minimum_size: int = 500, compresslevel: int = 9) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        bypass = False
+
+        async def routed(scope, receive, gzip_send):
+            async def route(message):
+                nonlocal bypass
+                if message["type"] == "http.response.start":
+                    content_type = Headers(raw=message["headers"]).get("content-type", "")
+                    bypass = _already_compressed(content_type)
+                # already compressed: every message goes straight out, skipping the gzip responder
+                await (send if bypass else gzip_send)(message)
+
+            await self.app(scope, receive, route)
+
+        gzip = GZipMiddleware(routed, minimum_size=self.minimum_size, compresslevel=self.compresslevel)
+        await gzip(scope, receive, send)
+
+
+app = FastAPI(title=APP_NAME, lifespan=lifespan)
+# Level 6: most of the ratio of 9 at a fraction of the CPU
+app.add_middleware(_TextGZipMiddleware, minimum_size=1024, compresslevel=6)
 templates = Jinja2Templates(directory="templates")
 
 STATIC_DIR = Path(__file__).parent / "static"
@@ -45,109 +189,230 @@ def index(request: Request):
     )
 
 
-def _safe_decode(b: bytes) -> str:
-    # prova utf-8, se fallisce sostituisce i caratteri non validi
-    return b.decode("utf-8", errors="replace")
-
-def _run(cmd: list[str]) -> None:
-    p = subprocess.run(cmd, capture_output=True)  # <-- niente text=True
-    if p.returncode != 0:
-        stderr = _safe_decode(p.stderr or b"")
-        stdout = _safe_decode(p.stdout or b"")
-        detail = (stderr or stdout or "Command failed").strip()
-        detail = detail[-2000:]
-        raise HTTPException(status_code=400, detail=detail)
-
-
-def _lighten_with_ghostscript(input_pdf: Path, output_pdf: Path, preset: str) -> None:
-    gs_setting = GS_PRESETS[preset]
-    out = str(output_pdf.resolve())
-    cmd = [
-        "gs",
-        "-sDEVICE=pdfwrite",
-        "-dCompatibilityLevel=1.4",
-        f"-dPDFSETTINGS={gs_setting}",
-        "-dSAFER",
-        "-dNOPAUSE", "-dBATCH",
-        "-sOutputFile=" + out,
-        str(input_pdf),
-    ]
-    print("GS CMD:", cmd)
-    _run(cmd)
-    print("GS OUTPUT EXISTS?", output_pdf.exists(), "SIZE:", output_pdf.stat().st_size if output_pdf.exists() else -1)
-    if not output_pdf.exists() or output_pdf.stat().st_size == 0:
+def _workdir_root(upload_size: int) -> str:
+    """TMP_ROOT se ha spazio sufficiente per il job, altrimenti la tempdir di sistema."""
+    try:
+        free = shutil.disk_usage(TMP_ROOT).free
+    except OSError:
+        return tempfile.gettempdir()
+    if free < upload_size * TMP_SPACE_FACTOR:
+        return tempfile.gettempdir()
+    return TMP_ROOT
+
+
+def _cache_path(digest: str, params: dict) -> Path:
+    key = "-".join(f"{k}={params[k]}" for k in sorted(params))
+    key_hash = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return CACHE_DIR / f"{digest}_{key_hash}.pdf"
+
+def _cache_touch(path: Path) -> bool:
+    """Cache hit: aggiorna mtime (= ultimo utilizzo, per l'LRU)."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def _cache_store(src: Path, dst: Path) -> bool:
+    """
+    Mette `src` in cache come `dst`, lasciando `src` al suo posto; False se non è stato
+    possibile (cache dir sparita, disco pieno, `dst` già evicted): si serve `src`.
+    """
+    part = None
+    try:
+        fd, part = tempfile.mkstemp(prefix=".", suffix=".part", dir=CACHE_DIR)
+        os.close(fd)
+        os.unlink(part)
+        try:
+            # stesso filesystem: hard link, nessuna copia
+            os.link(src, part)
+        except OSError:
+            # filesystem diverso (es. workdir su /dev/shm): copia
+            shutil.copyfile(src, part)
+        # rename atomico: un lettore non vede mai un PDF scritto a metà
+        os.replace(part, dst)
+    except OSError:
+        if part is not None:
+            Path(part).unlink(missing_ok=True)
+        return False
+    return _cache_evict(keep=dst)
+
+def _cache_evict(keep: Path | None = None) -> bool:
+    """
+    Rimuove i PDF usati meno di recente finché la cache non rientra in CACHE_MAX_MB.
+    False se `keep` è già stato rimosso (da un'eviction concorrente).
+    """
+    entries = []
+    for p in CACHE_DIR.glob("*.pdf"):
+        if p == keep:
+            # about to be served: may push the cache over the cap until the next store
+            continue
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, p))
+    total = sum(size for _, size, _ in entries)
+    if keep is not None:
+        try:
+            total += keep.stat().st_size
+        except FileNotFoundError:
+            return False
+    limit = CACHE_MAX_MB * 1024 * 1024
+    for _, size, p in sorted(entries):
+        if total <= limit:
+            break
+        p.unlink(missing_ok=True)
+        total -= size
+    return True
+
+
+class _UploadTarget(BaseTarget):
+    """
+    Target multipart per il PDF: scrive direttamente in `path` (nessuno spool intermedio),
+    calcola sha256 e dimensione e interrompe l'upload appena supera `max_bytes` o appena
+    il primo KiB rivela che non è un PDF.
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.received = False
+        self._fd = None
+        self._buffer = bytearray()
+        self._head = b""
+        self._head_checked = False
+
+    async def on_start_async(self):
+        if self.received:
+            # a second part would overwrite input.pdf while size/hash (the cache key) keep
+            # accumulating over both parts
+            raise HTTPException(status_code=400, detail="Only one file per request.")
+        self.received = True
+        self._fd = await aiofiles.open(self.path, "wb")
+
+    async def on_data_received_async(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise HTTPException(status_code=413, detail=f"File troppo grande (> {MAX_MB} MB).")
+        if not self._head_checked:
+            self._head += chunk[:PDF_HEADER_WINDOW - len(self._head)]
+            if len(self._head) >= PDF_HEADER_WINDOW:
+                self._check_header()
+        self.hasher.update(chunk)
+        self._buffer += chunk
+        if len(self._buffer) >= UPLOAD_BUFFER_SIZE:
+            await self._flush()
+
+    async def on_finish_async(self):
+        if not self._head_checked:
+            self._check_header()
+        await self._flush()
+        await self.aclose()
+
+    def _check_header(self):
+        # Garbage would otherwise cost a full gs run before failing
+        self._head_checked = True
+        if PDF_HEADER not in self._head:
+            raise HTTPException(status_code=415, detail="Il file non è un PDF (header %PDF- mancante).")
+
+    async def _flush(self):
+        if self._buffer:
+            await self._fd.write(self._buffer)
+            self._buffer.clear()
+
+    async def aclose(self):
+        if self._fd is not None:
+            await self._fd.close()
+            self._fd = None
+
+
+async def _receive_form(request: Request, upload: _UploadTarget) -> dict[str, str]:
+    """Legge il body multipart in streaming: il file va in `upload`, i campi nel dict restituito."""
+    fields = {
+        name: ValueTarget(validator=MaxSizeValidator(FORM_FIELD_MAX_BYTES))
+        for name in FORM_FIELDS
+    }
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register("file", upload)
+        for name, target in fields.items():
+            parser.register(name, target)
+        try:
+            async for chunk in request.stream():
+                await parser.adata_received(chunk)
+        finally:
+            await upload.aclose()
+    except ParseFailedException as e:
+        raise HTTPException(status_code=400, detail=f"Invalid multipart body: {e}") from None
+    except ValidationError:
         raise HTTPException(
-            status_code=400,
-            detail="Ghostscript did not produce output PDF (output_pdf missing or empty)."
-        )
+            status_code=413, detail=f"Form field too large (> {FORM_FIELD_MAX_BYTES} bytes)."
+        ) from None
 
+    if not upload.received:
+        raise HTTPException(status_code=400, detail="Missing file.")
+    return {name: _safe_decode(target.value) for name, target in fields.items() if target.value}
 
 
-def _qpdf_clean(input_pdf: Path, output_pdf: Path) -> None:
+async def _run_pipeline(tmpdir: Path, params: dict) -> Path:
     """
-    Pulizia/ottimizzazione "safe" senza OCR: non rasterizza e non altera layout/pagine.
-    Richiede qpdf installato nel sistema/container.
+    Converte in un worker. ocrmypdf usa le CPU non occupate dalle altre conversioni:
+    una richiesta isolata usa tutti i core, a pool pieno 1 core ciascuna.
     """
-    cmd = [
-        "qpdf",
-        "--object-streams=generate",
-        "--stream-data=compress",
-        str(input_pdf),
-        str(output_pdf),
-    ]
-    _run(cmd)
-
-def _ocr_optimize(
-    input_pdf: Path,
-    output_pdf: Path,
-    *,
-    do_ocr: bool,
-    autorotate: bool,
-    deskew: bool,
-    clean: bool,
-    oversample_level: int,
-) -> None:
-    # oversample in ocrmypdf is expressed in DPI. We expose a simple 1..4 slider.
-    oversample_map = {1: 150, 2: 300, 3: 400, 4: 600}
-    oversample_level = int(oversample_level or 2)
-    oversample_level = max(1, min(4, oversample_level))
-    oversample_dpi = oversample_map[oversample_level]
-
-    cmd = ["ocrmypdf"]
-
-    # OCR layer
-    if do_ocr:
-        cmd += ["--force-ocr", "-l", "ita+eng"]
-    else:
-        # NOTE: ocrmypdf does not provide a true "no OCR but apply preprocessing" mode.
-        # Using --skip-text avoids re-OCRing pages that already contain text.
-        cmd += ["--skip-text"]
-
-    # Page preprocessing
-    if autorotate:
-        cmd += ["--rotate-pages", "--rotate-pages-threshold", "2"]
-    if deskew:
-        cmd += ["--deskew"]
-    if clean:
-        cmd += ["--clean"]
-
-    if do_ocr:
-        cmd += ["--oversample", str(oversample_dpi)]
-
-    cmd += ["--optimize", "3", str(input_pdf), str(output_pdf)]
-    _run(cmd)
+    global _BUSY
+    _BUSY += 1
+    try:
+        ocr_jobs = max(1, CPUS // min(_BUSY, WORKERS))
+        return await _in_worker(pipeline.run, tmpdir, ocr_jobs=ocr_jobs, **params)
+    finally:
+        _BUSY -= 1
+
+
+def _pdf_response(path: Path, download_name: str, cleanup: Path | None = None) -> FileResponse:
+    # cleanup: tempdir removed by a background task once the body has been sent
+    background = BackgroundTask(shutil.rmtree, cleanup, ignore_errors=True) if cleanup else None
+    return FileResponse(path, media_type="application/pdf", filename=download_name, background=background)
+
 
 @app.post("/api/lighten")
-async def lighten(
-    file: UploadFile = File(...),
-    preset: str = Form(DEFAULT_PRESET),
-    ocr: int = Form(1 if ENABLE_OCR_DEFAULT else 0),
-    autorotate: int = Form(0),
-    deskew: int = Form(0),
-    clean: int = Form(1),
-    oversample: int = Form(2),
-):
-    # normalizza e valida (Form non fa pattern/ge/le come Query)
+async def lighten(request: Request):
+    max_bytes = MAX_MB * 1024 * 1024
+
+    # Basic guard: Content-Length already tells whether the upload is over the cap
+    try:
+        content_length = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > max_bytes + FORM_OVERHEAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File troppo grande (> {MAX_MB} MB).")
+
+    # The tempdir outlives this handler: it is removed by a background task once
+    # the response body has been sent (or right away if anything fails).
+    tmpdir = Path(tempfile.mkdtemp(prefix="pdflight_", dir=_workdir_root(content_length or max_bytes)))
+    try:
+        return await _lighten(request, tmpdir, max_bytes)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+async def _lighten(request: Request, tmpdir: Path, max_bytes: int) -> FileResponse:
+    # The upload is written once, straight into the working dir, while it is received
+    upload = _UploadTarget(tmpdir / "input.pdf", max_bytes)
+    form = await _receive_form(request, upload)
+
+    preset = form.get("preset", DEFAULT_PRESET)
+    ocr = form.get("ocr", 1 if ENABLE_OCR_DEFAULT else 0)
+    autorotate = form.get("autorotate", 0)
+    deskew = form.get("deskew", 0)
+    clean = form.get("clean", 1)
+    oversample = form.get("oversample", 2)
+
+    # normalizza e valida (i campi multipart arrivano come stringhe)
     preset = (preset or DEFAULT_PRESET).strip().lower()
     if preset not in GS_PRESETS:
         raise HTTPException(status_code=400, detail=f"Invalid preset: {preset}")
@@ -181,62 +446,62 @@ async def lighten(
     clean = 1 if clean else 0
     oversample = max(1, min(4, oversample))
 
-    # Basic guard
-    data = await file.read()
-    if len(data) > MAX_MB * 1024 * 1024:
-        raise HTTPException(status_code=413, detail=f"File troppo grande (> {MAX_MB} MB).")
+    # Se OCR è OFF, autorotate/deskew non devono avere effetto (sono opzioni del livello OCR)
+    if ocr == 0:
+        autorotate = 0
+        deskew = 0
 
-    with tempfile.TemporaryDirectory(prefix="pdflight_") as tmp:
-        tmpdir = Path(tmp)
-        in_pdf = tmpdir / "input.pdf"
-        mid_pdf = tmpdir / "light.pdf"
-        out_pdf = tmpdir / "output.pdf"
-
-        in_pdf.write_bytes(data)
-
-        _lighten_with_ghostscript(in_pdf, mid_pdf, preset)
-        if not mid_pdf.exists() or mid_pdf.stat().st_size == 0:
-           raise HTTPException(400, "Ghostscript did not produce output PDF (mid_pdf missing or empty).")
-
-        # --- Pipeline ---
-        # Livello 2 (OCR=1): analisi contenuto -> autorotate/deskew/clean/oversample
-        # Livello 1 (OCR=0): niente ocrmypdf (evita artefatti sulle scansioni); solo compressione + pulizia safe
-
-        # Se OCR è OFF, autorotate/deskew non devono avere effetto (sono opzioni del livello OCR)
-        if ocr == 0:
-            autorotate = 0
-            deskew = 0
-
-        if ocr == 1:
-            _ocr_optimize(
-                mid_pdf, out_pdf,
-                do_ocr=True,
-                autorotate=bool(autorotate),
-                deskew=bool(deskew),
-                clean=bool(clean),
-                oversample_level=oversample,
-            )
-        else:
-            # OCR OFF: evita ocrmypdf. Applica solo una pulizia "safe" se richiesta.
-            if bool(clean):
-                _qpdf_clean(mid_pdf, out_pdf)
-            else:
-                out_pdf = mid_pdf
-
-        original_name = Path(file.filename).stem
-        original_ext  = Path(file.filename).suffix
-
-        suffix = "_light"
-        if ocr == 1:
-           suffix += "_ocr"
-        elif bool(clean):
-           suffix += "_opt"
-
-        download_name = f"{original_name}{suffix}{original_ext}"
-
-        pdf_bytes = out_pdf.read_bytes()   # <-- IMPORTANTISSIMO: leggi dentro il with
-
-        headers = {
-            "Content-Disposition": f'attachment; filename="{download_name}"'
-        }
-        return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
+    filename = upload.multipart_filename or "document.pdf"
+    original_name = Path(filename).stem
+    original_ext  = Path(filename).suffix
+
+    suffix = "_light"
+    if ocr == 1:
+       suffix += "_ocr"
+    elif bool(clean):
+       suffix += "_opt"
+
+    download_name = f"{original_name}{suffix}{original_ext}"
+
+    params = dict(
+        preset=preset,
+        ocr=ocr,
+        autorotate=autorotate,
+        deskew=deskew,
+        clean=clean,
+        oversample=oversample,
+    )
+
+    if CACHE_MAX_MB <= 0:
+        out_pdf = await _run_pipeline(tmpdir, params)
+        return _pdf_response(out_pdf, download_name, cleanup=tmpdir)
+
+    cache_pdf = _cache_path(upload.hasher.hexdigest(), params)
+
+    # Identical concurrent uploads (same document, same options) share one conversion:
+    # the others wait for it and are served from the cache. If it fails, the next
+    # waiter runs its own.
+    while True:
+        if _cache_touch(cache_pdf):
+            await run_in_threadpool(shutil.rmtree, tmpdir, ignore_errors=True)
+            return _pdf_response(cache_pdf, download_name)
+        pending = _INFLIGHT.get(cache_pdf)
+        if pending is None:
+            break
+        await asyncio.wait({pending})
+
+    done = _INFLIGHT[cache_pdf] = asyncio.get_running_loop().create_future()
+    try:
+        out_pdf = await _run_pipeline(tmpdir, params)
+        stored = await run_in_threadpool(_cache_store, out_pdf, cache_pdf)
+    finally:
+        del _INFLIGHT[cache_pdf]
+        done.set_result(None)
+
+    if stored:
+        # Served from the cache: the working dir (RAM, on tmpfs) is released now
+        # instead of staying allocated for the whole download.
+        await run_in_threadpool(shutil.rmtree, tmpdir, ignore_errors=True)
+        return _pdf_response(cache_pdf, download_name)
+
+    return _pdf_response(out_pdf, download_name, cleanup=tmpdir)
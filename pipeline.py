@@ -0,0 +1,312 @@
+"""
+Pipeline di conversione (Ghostscript -> ocrmypdf / pikepdf), eseguita nei processi worker.
+
+I worker (forkserver) importano solo questo modulo per eseguire `run` e `warmup`:
+niente app FastAPI, pool di processi o cache da ricostruire in ogni worker.
+"""
+import os
+import logging
+import shutil
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+
+import ocrmypdf
+import pikepdf
+from ocrmypdf.pdfinfo import Encoding, PdfInfo
+from fastapi import HTTPException
+
+
+LOG_LEVEL = os.getenv("PDFLIGHT_LOG_LEVEL", "INFO").upper()
+
+logger = logging.getLogger("pdflight")
+logger.setLevel(LOG_LEVEL)
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(levelname)s:     %(name)s - %(message)s"))
+    logger.addHandler(_log_handler)
+
+# One thread per tesseract process: pages (and workers) already run in parallel,
+# OpenMP threads on top would only oversubscribe the CPUs.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+# ocrmypdf keeps a raster (at the oversample DPI), the preprocessed images and the text
+# layer of every page until the end: that grows with pages x DPI, not with the upload
+# size. About 20x for typical scans (one JPEG per page); below this much free space its
+# work folder goes to disk while the PDFs stay on tmpfs.
+OCR_TMP_SPACE_FACTOR = 20
+
+# Ghostscript can pick a pathological resolution and spin for hours: bound each run
+# to base + per-page seconds, so a stuck job cannot pin a worker.
+GS_TIMEOUT_S = float(os.getenv("PDFLIGHT_GS_TIMEOUT_S", "60"))
+GS_TIMEOUT_PER_PAGE_S = float(os.getenv("PDFLIGHT_GS_TIMEOUT_PER_PAGE_S", "2"))
+
+GS_PRESETS = {
+    "screen": "/screen",
+    "ebook": "/ebook",
+    "printer": "/printer",
+    "prepress": "/prepress",
+}
+# Static part of every gs command line, built once
+_GS_BASE = ("gs", "-sDEVICE=pdfwrite", "-dCompatibilityLevel=1.4", "-dSAFER", "-dNOPAUSE", "-dBATCH")
+_GS_PRESET_ARGS = {preset: f"-dPDFSETTINGS={setting}" for preset, setting in GS_PRESETS.items()}
+# Image resolution of each PDFSETTINGS preset: gs only downsamples images above
+# dpi x DownsampleThreshold (1.5) and passes the other JPEGs through untouched.
+GS_PRESET_DPI = {"screen": 72, "ebook": 150, "printer": 300, "prepress": 300}
+GS_DOWNSAMPLE_THRESHOLD = 1.5
+# Inputs smaller than this are not worth a gs run
+GS_SKIP_BELOW_KB = int(os.getenv("PDFLIGHT_GS_SKIP_BELOW_KB", "64"))
+
+
+def warmup() -> None:
+    """
+    Initializer dei worker: unpickling questa funzione importa già questo modulo (e con
+    esso ocrmypdf e pikepdf); qui si caricano anche i plugin di PIL.
+    """
+    import PIL.Image
+    PIL.Image.preinit()
+
+
+def _safe_decode(b: bytes) -> str:
+    # prova utf-8, se fallisce sostituisce i caratteri non validi
+    return b.decode("utf-8", errors="replace")
+
+def _command_failed(stdout: bytes, stderr: bytes) -> HTTPException:
+    detail = (_safe_decode(stderr or b"") or _safe_decode(stdout or b"") or "Command failed").strip()
+    detail = detail[-2000:]
+    return HTTPException(status_code=400, detail=detail)
+
+def _timed_out(cmd: list[str], timeout: float) -> HTTPException:
+    return HTTPException(status_code=504, detail=f"{cmd[0]} timed out after {timeout:.0f}s.")
+
+def _run(cmd: list[str], timeout: float | None = None) -> None:
+    # Blocking is fine here: this runs inside an EXEC worker, not on the event loop
+    try:
+        p = subprocess.run(cmd, capture_output=True, timeout=timeout)  # <-- niente text=True
+    except subprocess.TimeoutExpired:
+        raise _timed_out(cmd, timeout) from None
+    if p.returncode != 0:
+        raise _command_failed(p.stdout, p.stderr)
+
+
+def _ghostscript_cmd(input_pdf: Path, output_pdf: Path, preset: str) -> list[str]:
+    return [
+        *_GS_BASE,
+        _GS_PRESET_ARGS[preset],
+        f"-sOutputFile={output_pdf}",
+        str(input_pdf),
+    ]
+
+def _pdf_info(input_pdf: Path) -> PdfInfo | None:
+    """Immagini (codifica, DPI) di ogni pagina; None se pikepdf non riesce a leggere il PDF."""
+    try:
+        # serial: the worker process already has its own core, no thread pool per request
+        return PdfInfo(input_pdf, max_workers=1, use_threads=False)
+    except Exception:
+        return None
+
+def _ghostscript_timeout(info: PdfInfo | None) -> float:
+    # unreadable for pikepdf: gs may still repair it, with the base budget
+    pages = len(info) if info is not None else 0
+    return GS_TIMEOUT_S + GS_TIMEOUT_PER_PAGE_S * pages
+
+def _ghostscript_would_help(info: PdfInfo | None, preset: str) -> bool:
+    """False se gs non ridurrebbe il PDF: solo immagini JPEG già entro la risoluzione del preset."""
+    if info is None:
+        # let gs deal with (and report on) whatever pikepdf cannot read
+        return True
+    images = [image for page in info for image in page.images]
+    if not images:
+        return True
+    max_dpi = GS_PRESET_DPI[preset] * GS_DOWNSAMPLE_THRESHOLD
+    return not all(
+        image.enc == Encoding.jpeg and max(image.dpi.x, image.dpi.y) <= max_dpi
+        for image in images
+    )
+
+def _lighten_with_ghostscript(input_pdf: Path, output_pdf: Path, preset: str, timeout: float) -> None:
+    # tmpdir paths are already absolute: no resolve() (realpath) needed
+    cmd = _ghostscript_cmd(input_pdf, output_pdf, preset)
+    logger.debug("gs cmd: %s", cmd)
+    _run(cmd, timeout=timeout)
+    if logger.isEnabledFor(logging.DEBUG):
+        # stat only when the record is actually emitted
+        logger.debug("gs output: exists=%s size=%d", output_pdf.exists(),
+                     output_pdf.stat().st_size if output_pdf.exists() else -1)
+    if not output_pdf.exists() or output_pdf.stat().st_size == 0:
+        raise HTTPException(
+            status_code=400,
+            detail="Ghostscript did not produce output PDF (output_pdf missing or empty)."
+        )
+
+
+
+def _qpdf_clean(input_pdf: Path, output_pdf: Path) -> None:
+    """
+    Pulizia/ottimizzazione "safe" senza OCR: non rasterizza e non altera layout/pagine.
+    Stesso effetto di `qpdf --object-streams=generate --stream-data=compress`, ma via
+    pikepdf (libqpdf) nel processo worker, senza fork/exec.
+    """
+    try:
+        with pikepdf.open(input_pdf) as pdf:
+            pdf.save(
+                output_pdf,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                compress_streams=True,
+            )
+    except pikepdf.PdfError as e:
+        raise HTTPException(status_code=400, detail=str(e)[-2000:]) from None
+
+def _ocr_failed(e: Exception) -> HTTPException:
+    detail = (str(e) or type(e).__name__).strip()
+    return HTTPException(status_code=400, detail=detail[-2000:])
+
+def _ocr_optimize(
+    input_pdf: Path,
+    output_pdf: Path,
+    *,
+    do_ocr: bool,
+    autorotate: bool,
+    deskew: bool,
+    clean: bool,
+    oversample_level: int,
+    jobs: int,
+) -> None:
+    """
+    OCR + preprocessing via ocrmypdf.ocr(), in-process: nessun avvio di interprete
+    e plugin per richiesta in un worker già caldo.
+    """
+    # oversample in ocrmypdf is expressed in DPI. We expose a simple 1..4 slider.
+    oversample_map = {1: 150, 2: 300, 3: 400, 4: 600}
+    oversample_level = int(oversample_level or 2)
+    oversample_level = max(1, min(4, oversample_level))
+    oversample_dpi = oversample_map[oversample_level]
+
+    opts = dict(optimize=3, jobs=jobs, progress_bar=False)
+
+    # OCR layer
+    if do_ocr:
+        opts.update(force_ocr=True, language=["ita", "eng"])
+    else:
+        # NOTE: ocrmypdf does not provide a true "no OCR but apply preprocessing" mode.
+        # Using skip_text avoids re-OCRing pages that already contain text.
+        opts.update(skip_text=True)
+
+    # Page preprocessing
+    if autorotate:
+        opts.update(rotate_pages=True, rotate_pages_threshold=2.0)
+    if deskew:
+        opts.update(deskew=True)
+    if clean:
+        opts.update(clean=True)
+
+    if do_ocr:
+        opts.update(oversample=oversample_dpi)
+
+    try:
+        ocrmypdf.ocr(input_pdf, output_pdf, **opts)
+    except ocrmypdf.exceptions.ExitCodeException as e:
+        raise _ocr_failed(e) from None
+
+
+def _convert(
+    tmpdir: Path,
+    *,
+    preset: str,
+    ocr: int,
+    autorotate: int,
+    deskew: int,
+    clean: int,
+    oversample: int,
+    ocr_jobs: int = 1,
+) -> Path:
+    """Converte tmpdir/input.pdf e restituisce il path del PDF finale (dentro tmpdir)."""
+    in_pdf = tmpdir / "input.pdf"
+    mid_pdf = tmpdir / "light.pdf"
+    out_pdf = tmpdir / "output.pdf"
+
+    # gs non ridurrebbe il file (troppo piccolo / JPEG già a bassa risoluzione): saltalo.
+    # Una sola analisi del PDF serve sia al probe sia al budget di tempo di gs.
+    info = None
+    use_gs = in_pdf.stat().st_size >= GS_SKIP_BELOW_KB * 1024
+    if use_gs:
+        info = _pdf_info(in_pdf)
+        use_gs = _ghostscript_would_help(info, preset)
+    logger.debug("ghostscript %s for preset %s", "used" if use_gs else "skipped", preset)
+
+    # --- Pipeline ---
+    # Livello 2 (OCR=1): analisi contenuto -> autorotate/deskew/clean/oversample
+    # Livello 1 (OCR=0): niente ocrmypdf (evita artefatti sulle scansioni); solo compressione + pulizia safe
+    if ocr == 1:
+        # gs output goes to a file in tmpdir (tmpfs): ocrmypdf would copy a stream
+        # into its own work folder anyway, and could not start before gs is done
+        if use_gs:
+            _lighten_with_ghostscript(in_pdf, mid_pdf, preset, _ghostscript_timeout(info))
+        else:
+            mid_pdf = in_pdf
+        _ocr_optimize(
+            mid_pdf, out_pdf,
+            do_ocr=True,
+            autorotate=bool(autorotate),
+            deskew=bool(deskew),
+            clean=bool(clean),
+            oversample_level=oversample,
+            jobs=ocr_jobs,
+        )
+    else:
+        if use_gs:
+            _lighten_with_ghostscript(in_pdf, mid_pdf, preset, _ghostscript_timeout(info))
+            if not mid_pdf.exists() or mid_pdf.stat().st_size == 0:
+               raise HTTPException(400, "Ghostscript did not produce output PDF (mid_pdf missing or empty).")
+        else:
+            mid_pdf = in_pdf
+
+        # OCR OFF: evita ocrmypdf. Applica solo una pulizia "safe" se richiesta.
+        if bool(clean):
+            _qpdf_clean(mid_pdf, out_pdf)
+        else:
+            out_pdf = mid_pdf
+    return out_pdf
+
+
+def _scratch_dir(tmpdir: Path, ocr: int) -> Path:
+    """Dove creano i file temporanei gs/ocrmypdf: tmpdir se c'è spazio, altrimenti disco."""
+    if ocr != 1:
+        return tmpdir
+    try:
+        free = shutil.disk_usage(tmpdir).free
+    except OSError:
+        return tmpdir
+    if free < (tmpdir / "input.pdf").stat().st_size * OCR_TMP_SPACE_FACTOR:
+        return Path(tempfile.gettempdir())
+    return tmpdir
+
+
+@contextmanager
+def _tempdir(path: Path):
+    """
+    Redirige in `path` i file temporanei del job: tempfile (work folder di ocrmypdf)
+    e TMPDIR (gs, tesseract e gli altri sottoprocessi). Un worker esegue un job alla volta.
+    """
+    saved_tempdir, saved_env = tempfile.tempdir, os.environ.get("TMPDIR")
+    tempfile.tempdir = os.environ["TMPDIR"] = str(path)
+    try:
+        yield
+    finally:
+        tempfile.tempdir = saved_tempdir
+        if saved_env is None:
+            os.environ.pop("TMPDIR", None)
+        else:
+            os.environ["TMPDIR"] = saved_env
+
+
+def run(tmpdir: Path, **params) -> Path:
+    """Entry point eseguito in un processo worker: converte tmpdir/input.pdf."""
+    try:
+        with _tempdir(_scratch_dir(tmpdir, params["ocr"])):
+            return _convert(tmpdir, **params)
+    except HTTPException as e:
+        # HTTPException(status_code=..., detail=...) keeps no args and cannot be
+        # unpickled in the parent (it would break the pool): rebuild it positionally.
+        raise HTTPException(e.status_code, e.detail) from None
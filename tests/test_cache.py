@@ -0,0 +1,155 @@
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import httpx
+import pikepdf
+from fastapi import HTTPException
+
+import app
+
+
+class CacheStoreTest(unittest.TestCase):
+    def setUp(self):
+        root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.cache_dir = root / "cache"
+        self.cache_dir.mkdir()
+        self.enterContext(mock.patch.object(app, "CACHE_DIR", self.cache_dir))
+        self.enterContext(mock.patch.object(app, "CACHE_MAX_MB", 1))
+        self.src = root / "output.pdf"
+        self.src.write_bytes(b"%PDF-1.4\n" + b"0" * 1000)
+
+    def _entry(self, name: str, size: int, age: int) -> Path:
+        path = self.cache_dir / name
+        path.write_bytes(b"0" * size)
+        mtime = path.stat().st_mtime - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_store_keeps_the_source(self):
+        dst = self.cache_dir / "a.pdf"
+        self.assertTrue(app._cache_store(self.src, dst))
+        self.assertEqual(dst.read_bytes(), self.src.read_bytes())
+        self.assertEqual(list(self.cache_dir.glob(".*.part")), [])
+
+    def test_missing_cache_dir_is_not_stored(self):
+        shutil.rmtree(self.cache_dir)
+        self.assertFalse(app._cache_store(self.src, self.cache_dir / "a.pdf"))
+        self.assertTrue(self.src.exists())
+
+    def test_evicted_entry_is_not_stored(self):
+        dst = self.cache_dir / "a.pdf"
+        # a concurrent eviction removes the entry before it is accounted for
+        real_evict = app._cache_evict
+
+        def evict(keep):
+            keep.unlink()
+            return real_evict(keep=keep)
+
+        with mock.patch.object(app, "_cache_evict", evict):
+            self.assertFalse(app._cache_store(self.src, dst))
+        self.assertTrue(self.src.exists())
+
+    def test_eviction_drops_least_recently_used_but_spares_keep(self):
+        oldest = self._entry("oldest.pdf", 600 * 1024, age=30)
+        newer = self._entry("newer.pdf", 300 * 1024, age=20)
+        keep = self._entry("keep.pdf", 300 * 1024, age=100)
+
+        self.assertTrue(app._cache_evict(keep=keep))
+        self.assertFalse(oldest.exists())
+        self.assertTrue(newer.exists())
+        self.assertTrue(keep.exists())
+
+
+class CoalescingTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        cache_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        self.enterContext(mock.patch.object(app, "CACHE_DIR", cache_dir))
+        self.enterContext(mock.patch.object(app, "CACHE_MAX_MB", 1))
+        self.enterContext(mock.patch.object(app, "_run_pipeline", self._fake_pipeline))
+        self.real_touch = app._cache_touch
+        self.enterContext(mock.patch.object(app, "_cache_touch", self._counting_touch))
+
+        buffer = io.BytesIO()
+        with pikepdf.new() as pdf:
+            pdf.add_blank_page()
+            pdf.save(buffer)
+        self.pdf = buffer.getvalue()
+
+        self.conversions = 0
+        self.touches = 0
+        self.release = asyncio.Event()
+        self.fail_first = False
+
+        transport = httpx.ASGITransport(app=app.app)
+        self.client = httpx.AsyncClient(transport=transport, base_url="http://test")
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    async def _fake_pipeline(self, tmpdir: Path, params: dict) -> Path:
+        self.conversions += 1
+        first = self.conversions == 1
+        if first:
+            await self.release.wait()
+            if self.fail_first:
+                raise HTTPException(status_code=400, detail="conversion failed")
+        out_pdf = tmpdir / "output.pdf"
+        shutil.copyfile(tmpdir / "input.pdf", out_pdf)
+        return out_pdf
+
+    def _counting_touch(self, path: Path) -> bool:
+        self.touches += 1
+        return self.real_touch(path)
+
+    def _post(self) -> asyncio.Task:
+        return asyncio.create_task(self.client.post(
+            "/api/lighten",
+            files={"file": ("a.pdf", self.pdf, "application/pdf")},
+            data={"ocr": "0", "clean": "0"},
+        ))
+
+    async def _until(self, condition):
+        for _ in range(500):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail("timed out waiting for the requests")
+
+    async def test_identical_requests_share_one_conversion(self):
+        first = self._post()
+        await self._until(lambda: self.conversions == 1)
+        second = self._post()
+        # the second request found the first one in flight and is waiting on it
+        await self._until(lambda: self.touches == 2)
+        self.release.set()
+
+        responses = await asyncio.gather(first, second)
+        self.assertEqual([r.status_code for r in responses], [200, 200])
+        self.assertEqual(responses[0].content, responses[1].content)
+        self.assertEqual(self.conversions, 1)
+
+    async def test_failed_conversion_lets_one_waiter_retry(self):
+        self.fail_first = True
+        first = self._post()
+        await self._until(lambda: self.conversions == 1)
+        waiters = [self._post(), self._post()]
+        await self._until(lambda: self.touches == 3)
+        self.release.set()
+
+        responses = await asyncio.gather(first, *waiters)
+        self.assertEqual([r.status_code for r in responses], [400, 200, 200])
+        # one waiter converted again, the other was served its result from the cache
+        self.assertEqual(self.conversions, 2)
+        self.assertEqual(app._INFLIGHT, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import pikepdf
+from fastapi import HTTPException
+
+import pipeline
+
+# Fake gs: copies the input (last argument) to -sOutputFile,
+# after sleeping $FAKE_GS_SLEEP seconds.
+FAKE_GS = """#!/bin/sh
+for a in "$@"; do
+  case "$a" in -sOutputFile=*) out="${a#-sOutputFile=}" ;; esac
+  last="$a"
+done
+sleep "${FAKE_GS_SLEEP:-0}" >/dev/null 2>&1
+cat "$last" > "$out"
+"""
+
+
+def _slow_ocr(input_file, output_file, **opts):
+    """ocrmypdf.ocr stub: copia l'input, impiegando `seconds` secondi."""
+    data = Path(input_file).read_bytes()
+    time.sleep(_slow_ocr.seconds)
+    Path(output_file).write_bytes(data)
+
+
+class GhostscriptTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+
+        bin_dir = self.tmpdir / "bin"
+        bin_dir.mkdir()
+        gs = bin_dir / "gs"
+        gs.write_text(FAKE_GS)
+        gs.chmod(0o755)
+        path = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+        self.enterContext(mock.patch.dict(os.environ, {"PATH": path}))
+
+        self.input_pdf = self.tmpdir / "input.pdf"
+        with pikepdf.new() as pdf:
+            pdf.add_blank_page()
+            pdf.save(self.input_pdf)
+
+        self.enterContext(mock.patch.object(pipeline, "GS_TIMEOUT_S", 1.0))
+        self.enterContext(mock.patch.object(pipeline, "GS_TIMEOUT_PER_PAGE_S", 0.0))
+        self.enterContext(mock.patch.object(pipeline, "GS_SKIP_BELOW_KB", 0))
+        self.enterContext(mock.patch.object(pipeline.ocrmypdf, "ocr", _slow_ocr))
+
+    def _convert(self) -> Path:
+        return pipeline._convert(
+            self.tmpdir,
+            preset="ebook", ocr=1, autorotate=0, deskew=0, clean=0, oversample=2,
+        )
+
+    def test_slow_ocr_after_fast_gs_is_not_a_timeout(self):
+        _slow_ocr.seconds = 2.0
+        output_pdf = self._convert()
+        self.assertGreater(output_pdf.stat().st_size, 0)
+
+    def test_stuck_gs_times_out(self):
+        _slow_ocr.seconds = 0.0
+        with mock.patch.dict(os.environ, {"FAKE_GS_SLEEP": "10"}):
+            with self.assertRaises(HTTPException) as ctx:
+                self._convert()
+        self.assertEqual(ctx.exception.status_code, 504)
+
+
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+        with pikepdf.new() as pdf:
+            pdf.add_blank_page()
+            pdf.save(self.tmpdir / "input.pdf")
+        self.enterContext(mock.patch.object(pipeline, "GS_SKIP_BELOW_KB", 1 << 20))
+        self.enterContext(mock.patch.object(pipeline.ocrmypdf, "ocr", self._record_tempdir))
+
+    def _record_tempdir(self, input_file, output_file, **opts):
+        self.seen = (tempfile.gettempdir(), os.environ.get("TMPDIR"))
+        shutil.copyfile(input_file, output_file)
+
+    def _run(self):
+        pipeline.run(
+            self.tmpdir,
+            preset="ebook", ocr=1, autorotate=0, deskew=0, clean=0, oversample=2,
+        )
+
+    def test_ocr_temporary_files_go_to_the_workdir(self):
+        before = (tempfile.gettempdir(), os.environ.get("TMPDIR"))
+        self._run()
+        self.assertEqual(self.seen, (str(self.tmpdir), str(self.tmpdir)))
+        self.assertEqual((tempfile.gettempdir(), os.environ.get("TMPDIR")), before)
+
+    def test_ocr_temporary_files_go_to_disk_without_space(self):
+        with mock.patch.object(pipeline, "OCR_TMP_SPACE_FACTOR", 1 << 60):
+            self._run()
+        self.assertNotEqual(self.seen[0], str(self.tmpdir))
+        self.assertEqual(self.seen[0], self.seen[1])
+
+
+
+class GhostscriptProbeTest(unittest.TestCase):
+    def test_one_serial_analysis_gives_the_page_budget(self):
+        input_pdf = Path(tempfile.mkdtemp()) / "input.pdf"
+        self.addCleanup(shutil.rmtree, input_pdf.parent, ignore_errors=True)
+        with pikepdf.new() as pdf:
+            for _ in range(3):
+                pdf.add_blank_page()
+            pdf.save(input_pdf)
+
+        with mock.patch.object(pipeline, "PdfInfo", wraps=pipeline.PdfInfo) as pdf_info:
+            info = pipeline._pdf_info(input_pdf)
+        pdf_info.assert_called_once_with(input_pdf, max_workers=1, use_threads=False)
+        self.assertEqual(
+            pipeline._ghostscript_timeout(info), pipeline.GS_TIMEOUT_S + 3 * pipeline.GS_TIMEOUT_PER_PAGE_S
+        )
+        self.assertEqual(pipeline._ghostscript_timeout(None), pipeline.GS_TIMEOUT_S)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import io
+import unittest
+from unittest import mock
+
+import pikepdf
+
+import httpx
+
+import app
+
+BOUNDARY = "pdflightboundary"
+
+
+def _part(name: str, value: bytes, filename: str | None = None) -> bytes:
+    disposition = f'form-data; name="{name}"'
+    if filename:
+        disposition += f'; filename="{filename}"'
+    return (
+        f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n\r\n".encode()
+        + value + b"\r\n"
+    )
+
+
+def _pdf(pages: int) -> bytes:
+    buffer = io.BytesIO()
+    with pikepdf.new() as pdf:
+        for _ in range(pages):
+            pdf.add_blank_page()
+        pdf.save(buffer)
+    return buffer.getvalue()
+
+
+class UploadLimitsTest(unittest.IsolatedAsyncioTestCase):
+    async def _post(self, *parts: bytes) -> httpx.Response:
+        async def body():
+            # async generator: sent chunked, without Content-Length
+            for part in parts:
+                yield part
+            yield f"--{BOUNDARY}--\r\n".encode()
+
+        transport = httpx.ASGITransport(app=app.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post(
+                "/api/lighten",
+                content=body(),
+                headers={"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"},
+            )
+
+    async def test_oversized_form_field_is_rejected(self):
+        response = await self._post(
+            _part("preset", b"x" * (4 * 1024 * 1024)),
+            _part("file", b"%PDF-1.4\n", filename="a.pdf"),
+        )
+        self.assertEqual(response.status_code, 413)
+        self.assertLess(len(response.content), 1024)
+
+    async def test_non_pdf_upload_is_rejected(self):
+        response = await self._post(_part("file", b"hello" * 1000, filename="a.pdf"))
+        self.assertEqual(response.status_code, 415)
+
+    async def test_second_file_part_is_rejected(self):
+        response = await self._post(
+            _part("ocr", b"0"),
+            _part("clean", b"0"),
+            _part("file", _pdf(1), filename="a.pdf"),
+            _part("file", _pdf(2), filename="b.pdf"),
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class CompressionTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        transport = httpx.ASGITransport(app=app.app)
+        self.client = httpx.AsyncClient(transport=transport, base_url="http://test")
+        self.headers = {"Accept-Encoding": "gzip"}
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    async def test_pages_are_compressed(self):
+        response = await self.client.get("/static/style.css", headers=self.headers)
+        self.assertEqual(response.headers.get("content-encoding"), "gzip")
+
+    async def test_images_are_not_compressed(self):
+        logo = app.STATIC_DIR / "img" / "pdflight-logo.png"
+        response = await self.client.get("/static/img/pdflight-logo.png", headers=self.headers)
+        self.assertNotIn("content-encoding", response.headers)
+        self.assertEqual(response.headers["content-length"], str(logo.stat().st_size))
+
+    async def test_pdf_downloads_are_not_compressed(self):
+        size = 64 * 1024
+
+        async def lighten(request, tmpdir, max_bytes):
+            pdf = tmpdir / "output.pdf"
+            pdf.write_bytes(b"%PDF-1.4\n".ljust(size, b"0"))
+            return app._pdf_response(pdf, "output.pdf", cleanup=tmpdir)
+
+        with mock.patch.object(app, "_lighten", lighten):
+            response = await self.client.post("/api/lighten", headers=self.headers)
+        self.assertNotIn("content-encoding", response.headers)
+        self.assertEqual(response.headers["content-length"], str(size))
+
+
+if __name__ == "__main__":
+    unittest.main()
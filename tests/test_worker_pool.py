@@ -0,0 +1,57 @@
+import asyncio
+import os
+import signal
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from fastapi import HTTPException
+
+import app
+
+
+class WorkerPoolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.original_pool = app.EXEC
+        app.EXEC = app._new_pool()
+
+    async def asyncTearDown(self):
+        app.EXEC.shutdown(cancel_futures=True)
+        app.EXEC = self.original_pool
+
+    async def test_dead_worker_is_replaced(self):
+        pid = await app._in_worker(os.getpid)
+        broken_pool = app.EXEC
+        os.kill(pid, signal.SIGKILL)
+
+        # the pool notices the dead worker asynchronously
+        with self.assertRaises(HTTPException) as ctx:
+            for _ in range(50):
+                await app._in_worker(os.getpid)
+                await asyncio.sleep(0.1)
+        self.assertEqual(ctx.exception.status_code, 503)
+        self.assertIsNot(app.EXEC, broken_pool)
+
+        self.assertNotEqual(await app._in_worker(os.getpid), pid)
+
+
+class OcrJobsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_ocr_jobs_follow_pool_occupancy(self):
+        jobs = []
+        release = asyncio.Event()
+
+        async def fake_in_worker(fn, tmpdir, *, ocr_jobs, **params):
+            jobs.append(ocr_jobs)
+            await release.wait()
+
+        with mock.patch.object(app, "CPUS", 8), mock.patch.object(app, "WORKERS", 4), \
+                mock.patch.object(app, "_in_worker", fake_in_worker):
+            first = asyncio.create_task(app._run_pipeline(Path("a"), {}))
+            await asyncio.sleep(0)
+            second = asyncio.create_task(app._run_pipeline(Path("b"), {}))
+            await asyncio.sleep(0)
+            release.set()
+            await asyncio.gather(first, second)
+            await app._run_pipeline(Path("c"), {})
+
+        self.assertEqual(jobs, [8, 4, 8])